@@ -16,23 +16,183 @@ from __future__ import print_function, division  # requires Python >= 2.6
 
 # numpy and scipy imports
 import numpy as np
-from scipy.sparse import kron, identity, lil_matrix
+from scipy.sparse import kron, identity, csr_matrix, issparse
 from scipy.sparse.linalg import eigsh  # Lanczos routine from ARPACK
+from scipy.sparse.linalg import svds  # partial SVD, also from ARPACK
+# Thread pool used to solve several target sectors at the same time
+from multiprocessing.pool import ThreadPool
+# Used by the persistent cache of the blocks of the infinite system algorithm
+import hashlib
+import math  # factorials for the Wigner 6j symbols of the SU(2) mode
+import os
+import pickle
+import tempfile
+import zlib  # lossless compression of the operators of cold blocks
 
-# We will use python's "namedtuple" to represent the Block and EnlargedBlock
-# objects
 from collections import namedtuple
 
-Block = namedtuple("Block", ["length", "basis_size", "operator_dict", "basis_sector_array"])
-EnlargedBlock = namedtuple("EnlargedBlock", ["length", "basis_size", "operator_dict", "basis_sector_array"])
+# Operators with a smaller fraction of nonzero elements are stored as CSR
+# matrices.  (CSR takes less memory already below a fill of 2/3, but dense
+# products are faster until the matrix is quite sparse.)
+sparse_fill_threshold = 0.25
 
-def is_valid_block(block):
-    if len(block.basis_sector_array) != block.basis_size:
-        return False
-    for op in block.operator_dict.values():
-        if op.shape[0] != block.basis_size or op.shape[1] != block.basis_size:
+# Bumped whenever the pickled form of a Block or of a cache entry changes, so
+# that the persistent cache of the infinite system algorithm never loads
+# entries of an old format.
+block_format_version = 3
+
+def compact_operator(op):
+    """Returns `op` as a C-contiguous dense array or as a CSR matrix with
+    sorted indices, whichever suits its fill.
+    """
+    if issparse(op):
+        op = op.tocsr()
+        nnz = op.count_nonzero()
+    else:
+        op = np.asarray(op)
+        nnz = np.count_nonzero(op)
+    if nnz <= sparse_fill_threshold * op.shape[0] * op.shape[1]:
+        op = csr_matrix(op)
+        op.eliminate_zeros()
+        op.sort_indices()
+        return op
+    if issparse(op):
+        op = op.toarray()
+    return np.ascontiguousarray(op)
+
+def operator_nbytes(op):
+    """Returns the number of bytes occupied by the data of an operator as
+    stored by `Block`, including the index arrays of CSR matrices and the
+    compressed form of compressed operators.
+    """
+    if isinstance(op, CompressedOperator):
+        return sum(len(buffer) for buffer in op.buffers)
+    if issparse(op):
+        return op.data.nbytes + op.indices.nbytes + op.indptr.nbytes
+    return op.nbytes
+
+# Each array of an operator (the dense array, or the data, indices and indptr
+# of a CSR matrix) is compressed separately; `dtypes` are needed to read them
+# back.
+CompressedOperator = namedtuple("CompressedOperator", ["format", "shape", "dtypes", "buffers"])
+
+def compress_operator(op):
+    if issparse(op):
+        arrays = [op.data, op.indices, op.indptr]
+    else:
+        arrays = [op]
+    return CompressedOperator(format="csr" if issparse(op) else "dense",
+                            shape=op.shape,
+                            dtypes=[array.dtype.str for array in arrays],
+                            buffers=[zlib.compress(np.ascontiguousarray(array).tobytes()) for array in arrays])
+
+def decompress_operator(compressed):
+    # `np.frombuffer` gives read-only views of the decompressed bytes, so we
+    # copy them to hand out ordinary (writable) arrays.
+    arrays = [np.frombuffer(zlib.decompress(buffer), dtype=dtype).copy()
+            for dtype, buffer in zip(compressed.dtypes, compressed.buffers)]
+    if compressed.format == "csr":
+        return csr_matrix(tuple(arrays), shape=compressed.shape)
+    return arrays[0].reshape(compressed.shape)
+
+# We represent the Block and EnlargedBlock objects with a small class that
+# stores every operator compactly: a C-contiguous dense array if it is mostly
+# nonzero, a CSR matrix otherwise (the result of `rotate_and_truncate` is
+# dense even when, e.g., conservation of S^z makes most of it vanish).  A
+# block that is not needed for a while, such as the environment blocks kept on
+# "disk" during the sweeps, can additionally be compressed losslessly with
+# zlib; its operators are then decompressed on access.
+class Block(object):
+    """A block of the chain: its length, the size of its basis, the operators
+    we keep track of (`operator_dict`) and the S^z sector of each basis state
+    (`basis_sector_array`; twice the total spin of each multiplet in the SU(2)
+    mode).  The operators are stored by `compact_operator`.
+    """
+    __slots__ = ("length", "basis_size", "basis_sector_array", "_operators", "compressed")
+
+    def __init__(self, length, basis_size, operator_dict, basis_sector_array, compressed=False):
+        self.length = length
+        self.basis_size = basis_size
+        self.basis_sector_array = np.ascontiguousarray(basis_sector_array)
+        self._operators = dict((name, compact_operator(op)) for name, op in operator_dict.items())
+        self.compressed = False
+        if compressed:
+            self._operators = dict((name, compress_operator(op)) for name, op in self._operators.items())
+            self.compressed = True
+
+    @property
+    def operator_dict(self):
+        """A new dictionary of the operators.  Those of a compressed block are
+        decompressed anew on each access, so fetch it once per step."""
+        if self.compressed:
+            return dict((name, decompress_operator(op)) for name, op in self._operators.items())
+        return dict(self._operators)
+
+    def compress(self):
+        """Returns a copy of the block with its operators compressed."""
+        if self.compressed:
+            return self
+        return type(self)(self.length, self.basis_size, self._operators, self.basis_sector_array, compressed=True)
+
+    def is_valid(self):
+        """Checks that the sector array and every operator match the basis
+        size.  (We look at the operators as stored, since going through
+        `operator_dict` would decompress a compressed block only to check the
+        shapes.)"""
+        if len(self.basis_sector_array) != self.basis_size:
             return False
-    return True
+        for op in self._operators.values():
+            if op.shape[0] != self.basis_size or op.shape[1] != self.basis_size:
+                return False
+        return True
+
+    def nbytes(self):
+        """Returns the number of bytes occupied by the operators and the sector
+        array of the block."""
+        return self.basis_sector_array.nbytes + sum(operator_nbytes(op) for op in self._operators.values())
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return "%s(length=%d, basis_size=%d, operators=%s%s)" % (
+            type(self).__name__, self.length, self.basis_size, sorted(self._operators),
+            ", compressed" if self.compressed else "")
+
+class EnlargedBlock(Block):
+    __slots__ = ()
+
+def memory_report(block_disk, trmat_disk=None):
+    """Prints the memory occupied by each block in `block_disk` (and by each
+    transformation matrix in `trmat_disk`, if given) along with the totals,
+    and returns the total number of bytes.  A block stored under several keys
+    (as the blocks of the infinite system algorithm are) is only counted once.
+    """
+    total = 0
+    counted = set()
+    print("label length basis_size   operators(bytes)  compressed")
+    for (label, length), block in sorted(block_disk.items()):
+        nbytes = block.nbytes()
+        shared = id(block) in counted
+        print("%5s %6d %10d %18d  %s%s" % (label, length, block.basis_size, nbytes, block.compressed,
+                                        " (shared)" if shared else ""))
+        if not shared:
+            counted.add(id(block))
+            total += nbytes
+    print("total of the blocks: %.3f MB" % (total / 2.**20))
+    if trmat_disk is not None:
+        trmat_total = sum(operator_nbytes(trmat) for trmat in trmat_disk.values())
+        print("total of the transformation matrices: %.3f MB" % (trmat_total / 2.**20))
+        total += trmat_total
+    print("total: %.3f MB" % (total / 2.**20))
+    return total
+
+def is_valid_block(block):
+    return block.is_valid()
 
 # This function should test the same exact things, so there is no need to
 # repeat its definition.
@@ -43,12 +203,25 @@ def H2(Sz1, Sp1, Sz2, Sp2):  # two-site part of H
     (e.g. two blocks), returns a Kronecker product representing the
     corresponding two-site term in the Hamiltonian that joins the two sites.
     """
-    J = Jz = 1.
     return (
         (J / 2) * (kron(Sp1, Sp2.conjugate().transpose()) + kron(Sp1.conjugate().transpose(), Sp2)) +
         Jz * kron(Sz1, Sz2)
     )
 #
+def single_site_block():
+    """Returns the Block of a single site for the current model parameters.
+
+    conn refers to the connection operator, that is, the operator on the edge
+    of the block, on the interior of the chain.  We need to be able to
+    represent S^z and S^+ on that site in the current basis in order to grow
+    the chain.
+    """
+    return Block(length=1, basis_size=model_d, operator_dict={
+                "H": H1,
+                "conn_Sz": Sz1,
+                "conn_Sp": Sp1,
+                }, basis_sector_array=single_site_sectors)
+#
 def enlarge_block(block):
     """This function enlarges the provided Block by a single site, returning an
     EnlargedBlock.
@@ -82,7 +255,11 @@ def rotate_and_truncate(operator, transformation_matrix):
     """Transforms the operator to the new (possibly truncated) basis given by
     `transformation_matrix`.
     """
-    return transformation_matrix.conjugate().transpose().dot(operator.dot(transformation_matrix))
+    # The operator may be stored either dense or sparse (see `compact_operator`),
+    # so we only ever call the `dot` method of the (sparse) transformation
+    # matrix: O T = (T^T O^T)^T.
+    operator_times_trmat = transformation_matrix.transpose().dot(operator.transpose()).transpose()
+    return transformation_matrix.conjugate().transpose().dot(operator_times_trmat)
 
 def index_map(array):
     """Given an array, returns a dictionary that allows quick access to the
@@ -103,14 +280,150 @@ def index_map(array):
         d.setdefault(value, []).append(index)
     return d
 
-def single_dmrg_step(sys, env, m, target_Sz, psi0_guess=None):
+def perturbation_operators(operator_dict):
+    """Returns the operators of an (enlarged) block used for the
+    density-matrix correction, each paired with the change of the block's S^z
+    that it causes.  The operators may be stored dense or sparse (see
+    `compact_operator`); we return them as CSR matrices either way.
+    """
+    conn_Sp = csr_matrix(operator_dict["conn_Sp"])
+    return [
+        (csr_matrix(operator_dict["conn_Sz"]), 0),
+        (conn_Sp, 1),
+        (conn_Sp.conjugate().transpose().tocsr(), -1),
+    ]
+
+def randomized_svd(matrix, k, n_oversamples=10, n_power_iterations=2):
+    """Returns approximations to the `k` largest singular values of `matrix`
+    and the corresponding left singular vectors, found by projecting onto a
+    random subspace that is refined by a few power iterations.  A fixed seed
+    keeps the DMRG steps reproducible.
+    """
+    random_state = np.random.RandomState(0)
+    sketch = matrix.dot(random_state.standard_normal((matrix.shape[1], k + n_oversamples)))
+    for i in range(n_power_iterations):
+        # Re-orthonormalize between the multiplications to keep the small
+        # singular values from being lost to rounding.
+        sketch, _ = np.linalg.qr(sketch)
+        sketch, _ = np.linalg.qr(matrix.conjugate().transpose().dot(sketch))
+        sketch = matrix.dot(sketch)
+    q, _ = np.linalg.qr(sketch)
+    u, s, vh = np.linalg.svd(q.conjugate().transpose().dot(matrix), full_matrices=False)
+    return q.dot(u[:, :k]), s[:k]
+
+def truncate_by_svd(rho_factor_list, m, svd_method="full", multiplicity_list=None):
+    """Given the blocks of a reduced density matrix in the factorized form
+    rho = X X^dagger, finds the `m` overall most significant eigenvectors of
+    rho, which are the left singular vectors of the X with the largest
+    singular values.  Neither rho nor its full eigendecomposition is formed.
+
+    `svd_method` is "full" for a complete SVD of each block, or "partial"
+    (ARPACK) or "randomized" to compute only the leading `m` singular triplets
+    of blocks that are much larger than `m`.  If given, `multiplicity_list`
+    holds the number of degenerate copies of each state of a block (e.g. the
+    2j+1 states of an SU(2) multiplet), by which its weight counts towards the
+    discarded weight.  Returns, for each block, the kept eigenvectors (as
+    columns) and their positions in the new basis, which is ordered by
+    decreasing eigenvalue; the block of each element of the new basis; and the
+    discarded weight.
+    """
+    assert svd_method in ("full", "partial", "randomized")
+    if multiplicity_list is None:
+        multiplicity_list = [1] * len(rho_factor_list)
+    weights_list = []
+    vectors_list = []
+    discarded_weight = 0.
+    for rho_factor, multiplicity in zip(rho_factor_list, multiplicity_list):
+        k = min(m, min(rho_factor.shape))
+        if svd_method != "full" and 2 * k < min(rho_factor.shape):
+            if svd_method == "partial":
+                vectors, singular_values, _ = svds(rho_factor, k=k)
+            else:
+                vectors, singular_values = randomized_svd(rho_factor, k)
+            # The weight outside the span of the computed singular vectors is
+            # discarded.  We sum it directly as the squared norm of the part of
+            # X that they miss, rather than as |X|^2 minus the kept weight,
+            # which loses all precision once the discarded weight is small.
+            residual = rho_factor - vectors.dot(vectors.conjugate().transpose().dot(rho_factor))
+            discarded_weight += multiplicity * np.linalg.norm(residual) ** 2
+        else:
+            vectors, singular_values, _ = np.linalg.svd(rho_factor, full_matrices=False)
+        weights_list.append(singular_values ** 2)
+        vectors_list.append(vectors)
+
+    # Sort all candidate states by weight (largest eigenvalue first) and keep
+    # the first `m`.  The discarded weight is summed directly rather than
+    # obtained as one minus the kept weight.
+    weights = np.concatenate(weights_list)
+    block_array = np.repeat(np.arange(len(weights_list)), [len(w) for w in weights_list])
+    order = np.argsort(-weights, kind="mergesort")
+    kept = order[:m]
+    discarded_weight += np.sum(weights[order[m:]] * np.asarray(multiplicity_list)[block_array[order[m:]]])
+    is_kept = np.zeros(len(weights), dtype=bool)
+    is_kept[kept] = True
+    new_position = np.zeros(len(weights), dtype=int)
+    new_position[kept] = np.arange(len(kept))
+
+    kept_states = []
+    offset = 0
+    for vectors, block_weights in zip(vectors_list, weights_list):
+        block_is_kept = is_kept[offset:offset + len(block_weights)]
+        kept_states.append((vectors[:, block_is_kept], new_position[offset:offset + len(block_weights)][block_is_kept]))
+        offset += len(block_weights)
+    return kept_states, block_array[kept], discarded_weight
+
+def restricted_basis(sys_enl_basis_by_sector, env_enl_basis_by_sector, m_env_enl, target_Sz):
+    """Builds up a "restricted" basis of superblock states in the target
+    sector.  Returns a dictionary with the indices of the restricted basis for
+    which the enlarged system is in a given sector, along with the indices of
+    the full superblock basis that the restricted basis maps to.
+    """
+    sector_indices = {} # will contain indices of the new (restricted) basis
+                        # for which the enlarged system is in a given sector
+    restricted_basis_indices = []  # will contain indices of the old (full) basis, which we are mapping to
+    for sys_enl_Sz, sys_enl_basis_states in sys_enl_basis_by_sector.items():
+        sector_indices[sys_enl_Sz] = []
+        env_enl_Sz = target_Sz - sys_enl_Sz
+        if env_enl_Sz in env_enl_basis_by_sector:
+            for i in sys_enl_basis_states:
+                i_offset = m_env_enl * i  # considers the tensor product structure of the superblock basis
+                for j in env_enl_basis_by_sector[env_enl_Sz]:
+                    current_index = len(restricted_basis_indices)  # about-to-be-added index of restricted_basis_indices
+                    sector_indices[sys_enl_Sz].append(current_index)
+                    restricted_basis_indices.append(i_offset + j)
+    return sector_indices, restricted_basis_indices
+
+def single_dmrg_step(sys, env, m, target_Sz, psi0_guess=None, alpha=0., svd_method="full"):
     """Performs a single DMRG step using `sys` as the system and `env` as the
     environment, keeping a maximum of `m` states in the new basis.  If
     `psi0_guess` is provided, it will be used as a starting vector for the
-    Lanczos algorithm.
+    Lanczos algorithm.  If `alpha` is nonzero, White's density-matrix
+    correction with weight `alpha` is added to the reduced density matrix.
+    """
+    newblock, (energy,), transformation_matrix, (psi0,) = multi_sector_dmrg_step(
+        sys, env, m, target_Sz_list=[target_Sz], psi0_guess_list=[psi0_guess], alpha=alpha, svd_method=svd_method)
+    return newblock, energy, transformation_matrix, psi0
+
+def multi_sector_dmrg_step(sys, env, m, target_Sz_list, psi0_guess_list=None, alpha=0., svd_method="full"):
+    """Performs a single DMRG step using `sys` as the system and `env` as the
+    environment, targeting the ground state of each S^z sector in
+    `target_Sz_list` and keeping a maximum of `m` states in the new basis.
+
+    The blocks are enlarged and the superblock Hamiltonian is built only once,
+    after which the ground state of each target sector is found (in parallel
+    threads) from its restricted Hamiltonian.  The new basis is chosen from
+    the mixed density matrix that weights every target state equally, so that
+    a single block history describes all of them.  `svd_method` selects how
+    the most significant states are found (see `truncate_by_svd`).  Returns
+    the new block, the list of energies, the transformation matrix and the
+    list of psi0 (each in the sector-by-sector form used for eigenstate
+    prediction), in the order of `target_Sz_list`.
     """
     assert is_valid_block(sys)
     assert is_valid_block(env)
+    if psi0_guess_list is None:
+        psi0_guess_list = [None] * len(target_Sz_list)
+    assert len(psi0_guess_list) == len(target_Sz_list)
 
     # Enlarge each block by a single site.
     sys_enl = enlarge_block(sys)
@@ -132,77 +445,138 @@ def single_dmrg_step(sys, env, m, target_Sz, psi0_guess=None):
     env_enl_op = env_enl.operator_dict
     superblock_hamiltonian = kron(sys_enl_op["H"], identity(m_env_enl)) + kron(identity(m_sys_enl), env_enl_op["H"]) + \
                             H2(sys_enl_op["conn_Sz"], sys_enl_op["conn_Sp"], env_enl_op["conn_Sz"], env_enl_op["conn_Sp"])
+    superblock_hamiltonian = superblock_hamiltonian.tocsr()
     print("m_sys_enl:", m_sys_enl)
     print("m_env_enl:", m_env_enl)
     print("superblock_hamiltonian.shape:", superblock_hamiltonian.shape)
-    # Build up a "restricted" basis of states in the target sector and
-    # reconstruct the superblock Hamiltonian in that sector.
-    sector_indices = {} # will contain indices of the new (restricted) basis
-                        # for which the enlarged system is in a given sector
-    restricted_basis_indices = []  # will contain indices of the old (full) basis, which we are mapping to
-    for sys_enl_Sz, sys_enl_basis_states in sys_enl_basis_by_sector.items():
-        sector_indices[sys_enl_Sz] = []
-        env_enl_Sz = target_Sz - sys_enl_Sz
-        if env_enl_Sz in env_enl_basis_by_sector:
-            for i in sys_enl_basis_states:
-                i_offset = m_env_enl * i  # considers the tensor product structure of the superblock basis
-                for j in env_enl_basis_by_sector[env_enl_Sz]:
-                    current_index = len(restricted_basis_indices)  # about-to-be-added index of restricted_basis_indices
-                    sector_indices[sys_enl_Sz].append(current_index)
-                    restricted_basis_indices.append(i_offset + j)
+    perturbation_ops = perturbation_operators(sys_enl_op) if alpha != 0 else []
+
+    def solve_target_sector(target_Sz, psi0_guess):
+        # Reconstruct the superblock Hamiltonian in the target sector.
+        sector_indices, restricted_basis_indices = restricted_basis(sys_enl_basis_by_sector, env_enl_basis_by_sector,
+                                                                    m_env_enl, target_Sz)
+        restricted_superblock_hamiltonian = superblock_hamiltonian[:, restricted_basis_indices][restricted_basis_indices, :]
+        if psi0_guess is not None:
+            # `psi0_guess` is stored sector by sector, and the restricted
+            # basis runs over the same sectors in the same (row-major) order,
+            # so the restricted starting vector is simply the concatenation of
+            # the flattened sector blocks.  Sectors missing from the guess
+            # start out as zero.
+            restricted_psi0_guess = np.concatenate([
+                psi0_guess[sys_enl_Sz].reshape(-1) if sys_enl_Sz in psi0_guess else np.zeros(len(indices))
+                for sys_enl_Sz, indices in sector_indices.items() if indices
+            ])
+        else:
+            restricted_psi0_guess = None
+
+        # Call ARPACK to find the superblock ground state.  ("SA" means find
+        # the "smallest in amplitude" eigenvalue.)
+        (energy,), restricted_psi0 = eigsh(restricted_superblock_hamiltonian, k=1, which="SA", v0=restricted_psi0_guess)
+
+        # Each block of the reduced density matrix of the system, obtained by
+        # tracing out the environment, is rho = X X^dagger, where X is made up
+        # of the columns collected below.  We never form rho itself; instead
+        # the truncation works on X directly.  At the same time we keep psi0
+        # in this sector-by-sector form (one matrix per pair of system and
+        # environment sectors) for use in eigenstate prediction.
+        psi0 = {}
+        rho_factor_dict = {}
+        trace = 0.
+        for sys_enl_Sz, indices in sector_indices.items():
+            if indices: # if indices is nonempty
+                psi0_sector = restricted_psi0[indices, :]
+                # We want to make the (sys, env) indices correspond to (row,
+                # column) of a matrix, respectively.  Since the environment
+                # (column) index updates most quickly in our Kronecker product
+                # structure, psi0_sector is thus row-major ("C style").
+                psi0_sector = psi0_sector.reshape([len(sys_enl_basis_by_sector[sys_enl_Sz]), -1], order="C")
+                psi0[sys_enl_Sz] = psi0_sector
+                rho_factor_dict.setdefault(sys_enl_Sz, []).append(psi0_sector)
+                trace += np.linalg.norm(psi0_sector) ** 2
+
+                # Add White's density-matrix correction (perturbation), which
+                # mixes in the states reached by acting on psi0 with the
+                # connection operators of the enlarged system.  Since S^+ and
+                # S^- change the S^z of the system, this correction populates
+                # the neighbouring sectors as well, so a sweep can recover
+                # sectors that are missing from psi0 itself.
+                for op, delta_Sz in perturbation_ops:
+                    new_Sz = sys_enl_Sz + delta_Sz
+                    if new_Sz not in sys_enl_basis_by_sector:
+                        continue
+                    op_sector = op[sys_enl_basis_by_sector[new_Sz], :][:, sys_enl_basis_by_sector[sys_enl_Sz]]
+                    op_psi0_sector = np.sqrt(alpha) * op_sector.dot(psi0_sector)
+                    rho_factor_dict.setdefault(new_Sz, []).append(op_psi0_sector)
+                    trace += np.linalg.norm(op_psi0_sector) ** 2
+
+        if psi0_guess is not None:
+            overlap = np.absolute(np.dot(restricted_psi0_guess.conjugate(), restricted_psi0[:, 0]))
+            overlap /= np.linalg.norm(restricted_psi0_guess) * np.linalg.norm(restricted_psi0)  # normalize it
+        else:
+            overlap = None
+        return energy, psi0, rho_factor_dict, trace, overlap
 
-    restricted_superblock_hamiltonian = superblock_hamiltonian[:, restricted_basis_indices][restricted_basis_indices, :]
-    if psi0_guess is not None:
-        restricted_psi0_guess = psi0_guess[restricted_basis_indices]
+    # Solve each distinct target sector once (during the infinite system
+    # algorithm the scaled targets of different sectors often coincide), in
+    # parallel if there is more than one.  The worker threads do not print, so
+    # that their output cannot interleave; we report once they are done.
+    distinct_target_Sz_list = []
+    psi0_guess_by_target = {}
+    for target_Sz, psi0_guess in zip(target_Sz_list, psi0_guess_list):
+        if target_Sz not in distinct_target_Sz_list:
+            distinct_target_Sz_list.append(target_Sz)
+        if psi0_guess is not None:
+            psi0_guess_by_target.setdefault(target_Sz, psi0_guess)
+    arguments = [(target_Sz, psi0_guess_by_target.get(target_Sz)) for target_Sz in distinct_target_Sz_list]
+    if len(arguments) > 1:
+        pool = ThreadPool(len(arguments))
+        try:
+            results = pool.map(lambda args: solve_target_sector(*args), arguments)
+        finally:
+            pool.close()
+            pool.join()
     else:
-        restricted_psi0_guess = None
+        results = [solve_target_sector(*args) for args in arguments]
+    results_by_target = dict(zip(distinct_target_Sz_list, results))
+    for target_Sz in distinct_target_Sz_list:
+        overlap = results_by_target[target_Sz][4]
+        if overlap is not None:
+            print("target_Sz =", target_Sz, "overlap |<psi0_guess|psi0>| =", overlap)
 
-    # Call ARPACK to find the superblock ground state.  ("SA" means find the
-    # "smallest in amplitude" eigenvalue.)
-    (energy,), restricted_psi0 = eigsh(restricted_superblock_hamiltonian, k=1, which="SA", v0=restricted_psi0_guess)
+    # Mix the reduced density matrices of all target states with equal
+    # weights, normalizing each of them so that its trace is one.  Scaling
+    # the factor X by the square root of the weight scales rho = X X^dagger by
+    # the weight.
+    rho_factor_dict = {}
+    for target_Sz in distinct_target_Sz_list:
+        target_rho_factor_dict, trace = results_by_target[target_Sz][2:4]
+        scale = np.sqrt(1. / (len(distinct_target_Sz_list) * trace))
+        for Sz_sector, columns in target_rho_factor_dict.items():
+            rho_factor_dict.setdefault(Sz_sector, []).extend(scale * column for column in columns)
 
-    # Construct each block of the reduced density matrix of the system by
-    # tracing out the environment
-    rho_block_dict = {}
-    for sys_enl_Sz, indices in sector_indices.items():
-        if indices: # if indices is nonempty
-            psi0_sector = restricted_psi0[indices, :]
-            # We want to make the (sys, env) indices correspond to (row,
-            # column) of a matrix, respectively.  Since the environment
-            # (column) index updates most quickly in our Kronecker product
-            # structure, psi0_sector is thus row-major ("C style").
-            psi0_sector = psi0_sector.reshape([len(sys_enl_basis_by_sector[sys_enl_Sz]), -1], order="C")
-            rho_block_dict[sys_enl_Sz] = np.dot(psi0_sector, psi0_sector.conjugate().transpose())
-
-    # Diagonalize each block of the reduced density matrix and sort the
-    # eigenvectors by eigenvalue.
-    possible_eigenstates = []
-    for Sz_sector, rho_block in rho_block_dict.items():
-        evals, evecs = np.linalg.eigh(rho_block)
-        current_sector_basis = sys_enl_basis_by_sector[Sz_sector]
-        for eval, evec in zip(evals, evecs.transpose()):
-            possible_eigenstates.append((eval, evec, Sz_sector, current_sector_basis))
-    possible_eigenstates.sort(reverse=True, key=lambda x: x[0])  # largest eigenvalue first
-    print("len(possible_eigenstates):", len(possible_eigenstates))
-    # Build the transformation matrix from the `m` overall most significant
-    # eigenvectors.  It will have sparse structure due to the conserved quantum
-    # number.
-    my_m = min(len(possible_eigenstates), m)
-    transformation_matrix = lil_matrix((sys_enl.basis_size, my_m), dtype='d')
-    new_sector_array = np.zeros((my_m,), dtype='d')  # lists the sector of each
-                                                    # element of the new/truncated basis
-    for i, (eval, evec, Sz_sector, current_sector_basis) in enumerate(possible_eigenstates[:my_m]):
-        for j, v in zip(current_sector_basis, evec):
-            transformation_matrix[j, i] = v
-        new_sector_array[i] = Sz_sector
-    # Convert the transformation matrix to a more efficient internal
-    # representation.  `lil_matrix` is good for constructing a sparse matrix
-    # efficiently, but `csr_matrix` is better for performing quick
-    # multiplications.
-    transformation_matrix = transformation_matrix.tocsr()
+    # Keep the `m` overall most significant eigenvectors of the reduced
+    # density matrix, which are the left singular vectors of each block of X.
+    # The transformation matrix will have sparse structure due to the
+    # conserved quantum number.
+    sector_list = list(rho_factor_dict.keys())
+    rho_factor_list = [np.hstack(rho_factor_dict[Sz_sector]) for Sz_sector in sector_list]
+    kept_states, kept_block_array, truncation_error = truncate_by_svd(rho_factor_list, m, svd_method)
+    my_m = len(kept_block_array)
+    new_sector_array = np.array(sector_list, dtype='d')[kept_block_array]  # lists the sector of each
+                                                                        # element of the new/truncated basis
+    # Assemble the transformation matrix directly in `csr_matrix` form, which
+    # is best for performing quick multiplications.  Element (i, j) of each
+    # block of kept vectors belongs to row i of the sector's basis and column
+    # j of the new basis.
+    rows, columns, values = [], [], []
+    for Sz_sector, (vectors, new_indices) in zip(sector_list, kept_states):
+        rows.append(np.repeat(sys_enl_basis_by_sector[Sz_sector], len(new_indices)))
+        columns.append(np.tile(new_indices, vectors.shape[0]))
+        values.append(vectors.reshape(-1))
+    transformation_matrix = csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(columns))),
+                                    shape=(sys_enl.basis_size, my_m))
     print("transformation_matrix.shape:",transformation_matrix.shape)
-    truncation_error = 1 - sum([x[0] for x in possible_eigenstates[:my_m]])
-    #print("truncation error:", truncation_error)
+    print("truncation error:", truncation_error)
 
     # Rotate and truncate each operator.
     new_operator_dict = {}
@@ -214,16 +588,82 @@ def single_dmrg_step(sys, env, m, target_Sz, psi0_guess=None):
                     operator_dict=new_operator_dict,
                     basis_sector_array=new_sector_array)
 
-    # Construct psi0 (that is, in the full superblock basis) so we can use it
-    # later for eigenstate prediction.
-    psi0 = np.zeros([m_sys_enl * m_env_enl, 1], dtype='d')
-    for i, z in enumerate(restricted_basis_indices):
-        psi0[z, 0] = restricted_psi0[i, 0]
-    if psi0_guess is not None:
-        overlap = np.absolute(np.dot(psi0_guess.conjugate().transpose(), psi0).item())
-        overlap /= np.linalg.norm(psi0_guess) * np.linalg.norm(psi0)  # normalize it
-        print("overlap |<psi0_guess|psi0>| =", overlap)
-    return newblock, energy, transformation_matrix, psi0
+    energy_list = [results_by_target[target_Sz][0] for target_Sz in target_Sz_list]
+    psi0_list = [results_by_target[target_Sz][1] for target_Sz in target_Sz_list]
+    return newblock, energy_list, transformation_matrix, psi0_list
+
+def predict_psi0(psi0, sys_trmat, env_trmat, sys_prev_block, sys_block, env_prev_block, env_block, target_Sz):
+    """Predicts the ground state wavefunction of the next DMRG step from the
+    previous step's `psi0` and the known transformation matrices.
+
+    `psi0` is stored sector by sector as returned by `single_dmrg_step`: a
+    dictionary mapping each S^z of the enlarged system to the matrix of
+    amplitudes whose rows (columns) run over the enlarged system (environment)
+    basis states in that (the complementary) sector.  `sys_prev_block` and
+    `env_prev_block` are the blocks of the previous step, `sys_trmat` takes the
+    enlarged `sys_prev_block` to `sys_block`, and `env_trmat` takes the
+    enlarged `env_block` to `env_prev_block`.  The prediction is returned in
+    the same sector-by-sector form, so the full superblock vector is never
+    formed.
+    """
+    sys_enl_prev_basis_by_sector = index_map(np.add.outer(sys_prev_block.basis_sector_array, single_site_sectors).flatten())
+    sys_basis_by_sector = index_map(sys_block.basis_sector_array)
+    sys_enl_basis_by_sector = index_map(np.add.outer(sys_block.basis_sector_array, single_site_sectors).flatten())
+    env_prev_basis_by_sector = index_map(env_prev_block.basis_sector_array)
+    env_enl_prev_basis_by_sector = index_map(np.add.outer(env_prev_block.basis_sector_array, single_site_sectors).flatten())
+    env_enl_basis_by_sector = index_map(np.add.outer(env_block.basis_sector_array, single_site_sectors).flatten())
+
+    # psi0 currently looks e.g. like ===**--- but we need to transform it to
+    # look like ====**-- using the relevant transformation matrices and paying
+    # careful attention to the tensor product structure.
+    #
+    # Keep in mind that the tensor product of the superblock is
+    # (sys_enl_block, env_enl_block), which is equal to (sys_block,
+    # sys_extra_site, env_block, env_extra_site).  Note that this does *not*
+    # correspond to left-to-right order on the chain.
+    psi0_c = {}
+    for sys_enl_Sz, psi0_a in psi0.items():
+        if sys_enl_Sz not in sys_basis_by_sector:
+            continue  # every state of this sector has been truncated away
+
+        # First we transform the enlarged system block into a system block, so
+        # that psi0_b looks like ====*-- (with only one intermediate site).
+        # The transformation matrix conserves S^z, so only its block in the
+        # current sector is needed.
+        sys_trmat_sector = sys_trmat[sys_enl_prev_basis_by_sector[sys_enl_Sz], :][:, sys_basis_by_sector[sys_enl_Sz]]
+        psi0_b = sys_trmat_sector.conjugate().transpose().dot(psi0_a)
+
+        # At the moment, the tensor product goes as (sys_block, env_enl_block)
+        # == (sys_block, env_block, extra_site), but we need it to look like
+        # (sys_enl_block, env_block) == (sys_block, extra_site, env_block).  In
+        # other words, the single intermediate site should now be part of a
+        # new enlarged system, not part of the enlarged environment.  Moving
+        # the site shifts the S^z of the system by that of the site, so each
+        # column of psi0_b is sent to the sector given by its extra site.
+        sys_states = np.array(sys_basis_by_sector[sys_enl_Sz])
+        env_enl_prev_states = np.array(env_enl_prev_basis_by_sector[target_Sz - sys_enl_Sz])
+        for site_index, site_Sz in enumerate(single_site_sectors):
+            columns = (env_enl_prev_states % model_d == site_index)
+            if not columns.any():
+                continue
+            new_sys_enl_Sz = sys_enl_Sz + site_Sz
+            if new_sys_enl_Sz not in psi0_c:
+                psi0_c[new_sys_enl_Sz] = np.zeros((len(sys_enl_basis_by_sector[new_sys_enl_Sz]),
+                                                    len(env_prev_basis_by_sector[target_Sz - new_sys_enl_Sz])), dtype='d')
+            rows = np.searchsorted(sys_enl_basis_by_sector[new_sys_enl_Sz], sys_states * model_d + site_index)
+            psi0_c[new_sys_enl_Sz][rows, :] = psi0_b[:, columns]
+
+    # Finally, we transform the environment block into the basis of an
+    # enlarged block so that psi0_guess has the tensor product structure of
+    # ====**--.
+    psi0_guess = {}
+    for sys_enl_Sz, psi0_d in psi0_c.items():
+        env_Sz = target_Sz - sys_enl_Sz
+        if env_Sz not in env_enl_basis_by_sector:
+            continue
+        env_trmat_sector = env_trmat[env_enl_basis_by_sector[env_Sz], :][:, env_prev_basis_by_sector[env_Sz]]
+        psi0_guess[sys_enl_Sz] = env_trmat_sector.dot(psi0_d.transpose()).transpose()
+    return psi0_guess
 #
 def graphic(sys_block, env_block, sys_label="l"):
     """Returns a graphical representation of the DMRG step we are about to
@@ -249,7 +689,32 @@ def infinite_system_algorithm(L, m, target_Sz):
         block, energy, transformation_matrix, psi0 = single_dmrg_step(block, block, m=m, target_Sz=current_target_Sz)
         print("E/L =", energy / current_L)
 #========================================================================================================
-def idmrg_produce_blocks(L,m_warmup,target_Sz):
+def warmup_cache_key(m_warmup):
+    """Returns the content key of the initial block of the infinite system
+    algorithm: a hash of the model parameters and of `m_warmup`.  The block
+    produced by each later step is keyed by the key of the previous block
+    together with the distinct target sectors of that step (see
+    `idmrg_produce_blocks`).
+    """
+    key = hashlib.sha1()
+    key.update(repr((block_format_version, model_d, J, Jz, m_warmup)).encode())
+    for array in (single_site_sectors, Sz1, Sp1, H1):
+        key.update(np.ascontiguousarray(array, dtype='d').tobytes())
+    return key.hexdigest()
+
+def idmrg_produce_blocks(L, m_warmup, target_Sz_list, cache_dir=None):
+    """Uses the infinite system algorithm to build up the blocks of every
+    length up to L/2, and returns them along with the psi0 of the last step.
+
+    If `cache_dir` is given, each block (with the energies and psi0 of the
+    step that produced it) is stored there under a content key that depends
+    on the model parameters, `m_warmup` and the distinct target sectors of
+    every step so far, and blocks already in the cache are loaded instead of
+    recomputed.  The blocks of the infinite system algorithm do not depend on
+    L except through the scaled target sectors, so e.g. a run at L=200 with
+    target_Sz = 0 reuses the growth of an earlier run at L=100 and only
+    extends it.
+    """
     assert L % 2 == 0 # require that L is an even number
     #
     block_disk = {} # "disk" storage for Block objects
@@ -257,65 +722,76 @@ def idmrg_produce_blocks(L,m_warmup,target_Sz):
     block = initial_block
     block_disk["l", block.length] = block
     block_disk["r", block.length] = block
+    if cache_dir is not None:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        key = warmup_cache_key(m_warmup)
     # idmrg to enlarge the block
     while 2 * block.length < L:
-        # Perform a single DMRG step and save the new Blok to "disk"
-        print(graphic(block, block))
         current_L = 2 * block.length + 2 # current superblock length
-        current_target_Sz = int(target_Sz) * current_L // L
-        block, energy, transformation_matrix, psi0 = single_dmrg_step(block, block, m=m_warmup, target_Sz=current_target_Sz)
-        print("E/L =", energy / current_L)
+        current_target_Sz_list = [int(target_Sz) * current_L // L for target_Sz in target_Sz_list]
+        if cache_dir is not None:
+            # `multi_sector_dmrg_step` solves each distinct target once and
+            # mixes them equally, so the step only depends on the set of
+            # targets; e.g. runs with target_Sz_list [0] and [0, 1] share the
+            # first steps, where both scale to S^z = 0.
+            key = hashlib.sha1((key + repr(sorted(set(current_target_Sz_list)))).encode()).hexdigest()
+            cache_path = os.path.join(cache_dir, key + ".pickle")
+        if cache_dir is not None and os.path.exists(cache_path):
+            # Load the new Block from the cache, along with the energy and psi0
+            # of each target sector.
+            with open(cache_path, "rb") as f:
+                block, results_by_target = pickle.load(f)
+            energy_list = [results_by_target[target_Sz][0] for target_Sz in current_target_Sz_list]
+            psi0_list = [results_by_target[target_Sz][1] for target_Sz in current_target_Sz_list]
+            print(graphic(block, block), "(from cache)")
+        else:
+            # Perform a single DMRG step and save the new Blok to "disk"
+            print(graphic(block, block))
+            block, energy_list, transformation_matrix, psi0_list = multi_sector_dmrg_step(block, block, m=m_warmup,
+                                                                                        target_Sz_list=current_target_Sz_list)
+            if cache_dir is not None:
+                # Write to a temporary file of our own first, so that neither an
+                # interrupted run nor another run writing the same entry at the
+                # same time ever leaves a truncated entry in the cache.
+                results_by_target = dict(zip(current_target_Sz_list, zip(energy_list, psi0_list)))
+                fd, temporary_path = tempfile.mkstemp(suffix=".tmp", dir=cache_dir)
+                try:
+                    with os.fdopen(fd, "wb") as f:
+                        pickle.dump((block, results_by_target), f, pickle.HIGHEST_PROTOCOL)
+                    os.rename(temporary_path, cache_path)
+                finally:
+                    # Only still there if writing or renaming failed
+                    if os.path.exists(temporary_path):
+                        os.remove(temporary_path)
+        for target_Sz, energy in zip(current_target_Sz_list, energy_list):
+            print("target_Sz =", target_Sz, "E/L =", energy / current_L)
         block_disk["l", block.length] = block
         block_disk["r", block.length] = block
     # print("after idmrg, we get block_disk:\n", block_disk)
-    return block_disk, psi0
+    return block_disk, psi0_list
 #
-if __name__ == "__main__":
-    np.set_printoptions(precision=10, suppress=True, threshold=10000, linewidth=300)
-
-    #infinite_system_algorithm(L=100, m=20, target_Sz=0)
-    #finite_system_algorithm(L=20, m_warmup=10, m_sweep_list=[20,30,40,50], target_Sz=0)
-    # Model-specific code for the Heisenberg XXZ chain
-    #
-    model_d = 2  # single-site basis size
-    single_site_sectors = np.array([0.5, -0.5])  # S^z sectors corresponding to the
-                                                # single site basis elements
-
-    Sz1 = np.array([[0.5, 0], [0, -0.5]], dtype='d')  # single-site S^z
-    Sp1 = np.array([[0, 1], [0, 0]], dtype='d')  # single-site S^+
-
-    H1 = np.array([[0, 0], [0, 0]], dtype='d')  # single-site portion of H is zero
-    #
-    # conn refers to the connection operator, that is, the operator on the edge of
-    # the block, on the interior of the chain.  We need to be able to represent S^z
-    # and S^+ on that site in the current basis in order to grow the chain.
-    initial_block = Block(length=1, basis_size=model_d, operator_dict={
-                        "H": H1,
-                        "conn_Sz": Sz1,
-                        "conn_Sp": Sp1,
-                        }, basis_sector_array=single_site_sectors)
-    #
-    L = 20
-    m_warmup = 20
-    target_Sz = 0
-    block_disk, psi0 = idmrg_produce_blocks(L=L, m_warmup=m_warmup,target_Sz=target_Sz)
-    #
-    print("--------idmrg enlarge block finished, begin fdmrg process--------")
-    # Now that the system is built up to its full size, we perform sweeps using
-    # the finite system algorithm. At first the left block will act as the system
-    # growing at the expense of the right block (the environment), but once
-    # we come to the end of the chian these roles will be reversed
-    # 
-    m_sweep_list = [30]
-    trmat_disk = {} # "disk" storage for transformation matrix
+def finite_system_sweeps(L, m_sweep_list, alpha_sweep_list, target_Sz_list, block_disk, trmat_disk, psi0_list=None,
+                        svd_method="full", compress_cold_blocks=False):
+    """Performs sweeps of the finite system algorithm, starting with the block
+    `block_disk["l", L // 2]` as the system and targeting the ground state of
+    each S^z sector in `target_Sz_list`.  `block_disk` and `trmat_disk` are
+    updated in place.  If `trmat_disk` already holds the transformation
+    matrices that belong to `psi0_list` (e.g. when continuing a previous run),
+    the very first step starts from a predicted ground state as well.  Returns
+    the energies and psi0 of the last step, in the order of `target_Sz_list`.
+    `svd_method` is passed on to `multi_sector_dmrg_step`.  If
+    `compress_cold_blocks` is true, the blocks saved to `block_disk` are
+    compressed, since each of them is only needed again as the environment
+    half a sweep later.
+    """
+    assert L % 2 == 0  # require that L is an even number
+    assert len(alpha_sweep_list) == len(m_sweep_list)
     sys_label, env_label = "l", "r"
-    block = list(block_disk.values())[-1] 
-    # 
-    sys_block = block
-    del block
-    sys_trmat = None
-    # 
-    for m in m_sweep_list:
+    sys_block = block_disk[sys_label, L // 2]
+    sys_trmat = trmat_disk.get((sys_label, sys_block.length))
+    #
+    for m, alpha in zip(m_sweep_list, alpha_sweep_list):
         while True:
             print("************fdmrg begin*************************")
             print("len(block_disk):", len(block_disk))
@@ -327,89 +803,474 @@ if __name__ == "__main__":
             print("(env_label, L - sys_block.length - 1):", (env_label, L - sys_block.length - 1))
             #
             # If possible, predict an estimate of the ground state wavefunction
-            # from the previous step's psi0 and known transformation matrices.
-            if psi0 is None or sys_trmat is None or env_trmat is None:
-                psi0_guess = None
+            # of each target sector from the previous step's psi0 and known
+            # transformation matrices.
+            if psi0_list is None or sys_trmat is None or env_trmat is None:
+                psi0_guess_list = None
                 print("psi0_guess is None")
             else:
                 print("psi0_guess is not None")
                 print("psi0_guess is produced by last step psi0")
-                print("the shape of last step psi0:",psi0.shape)
-                # psi0 currently looks e.g. like ===**--- but we need to 
-                # transform it to look like ====**-- using the relevant
-                # transformation matrices and paying careful attention to the tensor product structure
-                #
-                # Keep in mind that the tensor product of the superblock is (sys_enl_block, env_enl_block),
-                # which is equal to (sys_block, sys_extra_site, env_block, env_extra_site).
-                # Note that this does *not* correspond to left-to-right order on the chain
-                #
-                # First we reshape the psi0 vector into a matrix with rows
-                # corresponding to the enlarged system basis and columns
-                # corresponding to the enlarged envirnment basis
-                psi0_a = psi0.reshape((-1, env_trmat.shape[1]*model_d), order="C") # psi0_a like ===**---
-                print("psi0_a.shape:",psi0_a.shape)
-                #
-                # Now we transform the enlarged system block into a system
-                # block, so that psi0_b looks like ====*-- (with only one intermediate site)
-                psi0_b = sys_trmat.conjugate().transpose().dot(psi0_a)
-                print("psi0_b.shape:", psi0_b.shape)
-                # At the moment, the tensor product goes as (sys_block,
-                # env_enl_block) == (sys_block, env_block, extra_site), but we
-                # need it to look like (sys_enl_block, env_block) ==
-                # (sys_block, extra_site, env_block).  In other words, the
-                # single intermediate site should now be part of a new enlarged
-                # system, not part of the enlarged environment.
-                psi0_c = psi0_b.reshape((-1, env_trmat.shape[1], model_d), order="C").transpose(0, 2, 1)
-                print("psi0_c.shape:", psi0_c.shape)
-                # Now we reshape the psi0 vector into a matrix with rows
-                # corresponding to the enlarged system and columns
-                # corresponding to the environment block.
-                psi0_d = psi0_c.reshape((-1, env_trmat.shape[1]), order="C")
-                print("psi0_d.shape:", psi0_d.shape)
-                # Finally, we transform the environment block into the basis of
-                # an enlarged block the so that psi0_guess has the tensor
-                # product structure of ====**--.
-                psi0_guess = env_trmat.dot(psi0_d.transpose()).transpose().reshape((-1, 1))
-                print("psi0_guess.shape:", psi0_guess.shape)
+                # psi0 is kept sector by sector, so the prediction works on one
+                # small matrix per pair of system and environment sectors.
+                psi0_guess_list = []
+                for target_Sz, psi0 in zip(target_Sz_list, psi0_list):
+                    print("the size of last step psi0:", sum(psi0_sector.size for psi0_sector in psi0.values()))
+                    psi0_guess = predict_psi0(psi0, sys_trmat, env_trmat,
+                                            sys_prev_block=block_disk[sys_label, sys_block.length - 1],
+                                            sys_block=sys_block,
+                                            env_prev_block=block_disk[env_label, L - sys_block.length - 1],
+                                            env_block=env_block,
+                                            target_Sz=target_Sz)
+                    print("psi0_guess.size:", sum(psi0_sector.size for psi0_sector in psi0_guess.values()))
+                    psi0_guess_list.append(psi0_guess)
                 #
 
             if env_block.length == 1:
                 # We've come to the end of the chain, so we reverse course.
                 sys_block, env_block = env_block, sys_block
                 sys_label, env_label = env_label, sys_label
-                if psi0_guess is not None:
+                if psi0_guess_list is not None:
                     # Re-order psi0_guess based on the new sys, env labels.
-                    psi0_guess = psi0_guess.reshape((sys_trmat.shape[1] * model_d, 
-                                                    env_trmat.shape[0]), order="C").transpose().reshape((-1, 1))
-                    print("psi0_guess as an input to single_dmrg_step")
+                    # The sector of the new system is that of the old
+                    # environment.
+                    psi0_guess_list = [dict((target_Sz - sys_enl_Sz, psi0_sector.transpose())
+                                            for sys_enl_Sz, psi0_sector in psi0_guess.items())
+                                    for target_Sz, psi0_guess in zip(target_Sz_list, psi0_guess_list)]
+                    print("psi0_guess as an input to multi_sector_dmrg_step")
             #
             # Perform a single DMRG step.
             print(graphic(sys_block, env_block, sys_label))
-            sys_block, energy, sys_trmat, psi0 = single_dmrg_step(sys_block, env_block, m=m, 
-                                                                target_Sz=target_Sz, psi0_guess=psi0_guess)
+            sys_block, energy_list, sys_trmat, psi0_list = multi_sector_dmrg_step(sys_block, env_block, m=m,
+                                                                                target_Sz_list=target_Sz_list,
+                                                                                psi0_guess_list=psi0_guess_list,
+                                                                                alpha=alpha, svd_method=svd_method)
             print("sys_trmat.shape:", sys_trmat.shape)
-            print("psi0.shape:", psi0.shape)
-            print("psi0.shape()[0]/sys_trmat.shape()[0]:", psi0.shape[0]/sys_trmat.shape[0])
             print("env_label:", env_label)
             if env_trmat is None:
                 print("env_trmat:", env_trmat)
             else:
                 print("env_trmat.shape:", env_trmat.shape)
-            if psi0_guess is None:
-                print("psi0_guess:", psi0_guess)
-            else:
-                print("len(psi0_guess):", len(psi0_guess))
-            print("E/L =", energy / L)
+            for target_Sz, energy in zip(target_Sz_list, energy_list):
+                print("target_Sz =", target_Sz, "E/L =", energy / L)
             print("#")
             #
             # Save the block and transformation matrix from this step to disk.
-            block_disk[sys_label, sys_block.length] = sys_block
+            # (We keep working with the uncompressed block as the system.)
+            if compress_cold_blocks:
+                block_disk[sys_label, sys_block.length] = sys_block.compress()
+            else:
+                block_disk[sys_label, sys_block.length] = sys_block
             trmat_disk[sys_label, sys_block.length] = sys_trmat
 
             # Check whether we just completed a full sweep.
             if sys_label == "l" and 2 * sys_block.length == L:
                 break  # escape from the "while True" loop
+    return energy_list, psi0_list
+#
+def rebuild_blocks(L, block_disk, trmat_disk):
+    """Re-evaluates the operators of the blocks stored by a previous run in the
+    basis that run kept, using the current model parameters, and returns them
+    as a new block "disk".
+
+    After a completed sweep the left blocks up to the middle of the chain and
+    all of the right blocks form a consistent chain, each obtained from the
+    previous one through its stored transformation matrix.  We rebuild exactly
+    the blocks that the next sweep needs before it regenerates the rest.
+    The single-site block is built anew as well, since the single-site part
+    of H (e.g. a magnetic field) may have changed.
+    """
+    assert L % 2 == 0  # require that L is an even number
+    new_block_disk = {}
+    for label, max_length in (("l", L // 2), ("r", L // 2 - 1)):
+        block = single_site_block()
+        new_block_disk[label, block.length] = block
+        while block.length < max_length:
+            enlarged_block = enlarge_block(block)
+            transformation_matrix = trmat_disk[label, enlarged_block.length]
+            stored_block = block_disk[label, enlarged_block.length]
+            new_operator_dict = {}
+            for name, op in enlarged_block.operator_dict.items():
+                new_operator_dict[name] = rotate_and_truncate(op, transformation_matrix)
+            block = Block(length=enlarged_block.length,
+                        basis_size=stored_block.basis_size,
+                        operator_dict=new_operator_dict,
+                        basis_sector_array=stored_block.basis_sector_array)
+            assert is_valid_block(block)
+            new_block_disk[label, block.length] = block
+    return new_block_disk
+#========================================================================================================
+# SU(2)-symmetric mode for the isotropic Heisenberg chain (J = Jz, no field).
+#
+# Here each basis element of a block is a whole multiplet of total spin j,
+# whose 2j+1 states are never stored separately.  We reuse the Block
+# class, with `basis_size` counting multiplets and `basis_sector_array`
+# holding twice the total spin (2j) of each multiplet.  The operator_dict
+# holds the block Hamiltonian "H", a scalar stored by its (m-independent)
+# matrix elements, and the reduced matrix elements <j||S||j'> of the spin
+# vector on the connecting site, "conn_S" (in the convention of Edmonds,
+# Angular Momentum in Quantum Mechanics, in which the spin-1/2 site has
+# <1/2||S||1/2> = sqrt(3/2)).  Spins are passed around as twice their value so
+# that they are always integers.
+#
+def wigner_6j(a, b, c, d, e, f, _cache={}):
+    """Returns the Wigner 6j symbol {a/2 b/2 c/2; d/2 e/2 f/2} of the twice
+    spins `a`, ..., `f`, computed with the Racah formula.
+    """
+    key = (a, b, c, d, e, f)
+    if key in _cache:
+        return _cache[key]
+
+    def triangle(x, y, z):
+        return (x + y + z) % 2 == 0 and abs(x - y) <= z <= x + y
+
+    def delta(x, y, z):
+        return math.sqrt(math.factorial((x + y - z) // 2) * math.factorial((x - y + z) // 2) *
+                        math.factorial((-x + y + z) // 2) / math.factorial((x + y + z) // 2 + 1))
+
+    if not (triangle(a, b, c) and triangle(a, e, f) and triangle(d, b, f) and triangle(d, e, c)):
+        value = 0.
+    else:
+        triads = [(a + b + c) // 2, (a + e + f) // 2, (d + b + f) // 2, (d + e + c) // 2]
+        quads = [(a + b + d + e) // 2, (a + c + d + f) // 2, (b + c + e + f) // 2]
+        total = 0.
+        for t in range(max(triads), min(quads) + 1):
+            denominator = 1.
+            for x in triads:
+                denominator *= math.factorial(t - x)
+            for x in quads:
+                denominator *= math.factorial(x - t)
+            total += (-1) ** t * math.factorial(t + 1) / denominator
+        value = delta(a, b, c) * delta(a, e, f) * delta(d, b, f) * delta(d, e, c) * total
+    _cache[key] = value
+    return value
+
+def su2_scalar_coefficient(t1, t2, t, t1p, t2p, tp):
+    """Coefficient of <(j1 j2) j| A(1) B(2) |(j1' j2') j'> for scalar A and
+    B, in terms of their matrix elements."""
+    return float(t == tp)
+
+def su2_dot_coefficient(t1, t2, t, t1p, t2p, tp):
+    """Coefficient of <(j1 j2) j| T(1) . U(2) |(j1' j2') j'> for rank-1
+    tensors T and U, in terms of their reduced matrix elements (Edmonds
+    7.1.6)."""
+    if t != tp:
+        return 0.
+    return (-1) ** ((t1p + t2 + t) // 2) * wigner_6j(t, t2, t1, 2, t1p, t2p)
+
+def su2_second_coefficient(t1, t2, t, t1p, t2p, tp):
+    """Coefficient of the reduced matrix element <(j1 j2) j|| U(2) ||(j1 j2')
+    j'> of a rank-1 tensor U acting on the second of two coupled spaces, in
+    terms of <j2||U||j2'> (Edmonds 7.1.8)."""
+    return (-1) ** ((t1 + t2p + t + 2) // 2) * math.sqrt((t + 1) * (tp + 1)) * wigner_6j(t2, t, t1, tp, t2p, 2)
+
+def su2_coupled_operator(op1, spins1, op2, spins2, coupled_basis, coefficient):
+    """Returns the operator built from `op1` on the first and `op2` on the
+    second of two spaces, in a basis of coupled multiplets.
+
+    `coupled_basis` is a tuple of three arrays giving, for each coupled
+    multiplet, the index of its multiplet in the first space, the index of its
+    multiplet in the second space and twice its total spin.  The element
+    between coupled multiplets r and c is op1[r1, c1] * op2[r2, c2] times the
+    recoupling coefficient returned by `coefficient` for the twice spins of
+    (r1, r2, r, c1, c2, c).
+    """
+    index1, index2, coupled_spins = coupled_basis
+    size = len(coupled_spins)
+    pair_index = index1 * op2.shape[0] + index2
+    product = kron(op1, op2).tocsr()[pair_index, :][:, pair_index].tocoo()
+    if product.nnz == 0:
+        return csr_matrix((size, size), dtype='d')
+    row, col = product.row, product.col
+    spin_labels = np.array([spins1[index1[row]], spins2[index2[row]], coupled_spins[row],
+                            spins1[index1[col]], spins2[index2[col]], coupled_spins[col]])
+    # The coefficient only depends on the spins, so evaluate it once for each
+    # distinct combination.
+    distinct_labels, inverse = np.unique(spin_labels, axis=1, return_inverse=True)
+    factors = np.array([coefficient(*labels) for labels in distinct_labels.transpose().tolist()])
+    return csr_matrix((product.data * factors[inverse.reshape(-1)], (row, col)), shape=(size, size))
+
+def su2_enlarge_block(block):
+    """This function enlarges the provided SU(2) Block by a single site,
+    returning an EnlargedBlock.  Each multiplet of spin j of the block
+    combines with the spin-1/2 site into multiplets of spin j - 1/2 (if
+    j > 0) and j + 1/2.
+    """
+    mblock = block.basis_size
+    o = block.operator_dict
+    spins = block.basis_sector_array
+
+    # The coupled basis of the enlarged block: the multiplet of the block,
+    # the (only) multiplet of the site and twice the new total spin.
+    block_index = []
+    new_spins = []
+    for alpha, t in enumerate(spins):
+        for new_t in (t - single_site_spin, t + single_site_spin):
+            if new_t >= 0:
+                block_index.append(alpha)
+                new_spins.append(new_t)
+    coupled_basis = (np.array(block_index), np.zeros(len(block_index), dtype=int), np.array(new_spins))
+    site_spins = np.array([single_site_spin])
+    site_identity = np.array([[1.]])
+
+    enlarged_operator_dict = {
+        "H": su2_coupled_operator(o["H"], spins, site_identity, site_spins, coupled_basis, su2_scalar_coefficient) +
+            J * su2_coupled_operator(o["conn_S"], spins, S1_reduced, site_spins, coupled_basis, su2_dot_coefficient),
+        "conn_S": su2_coupled_operator(identity(mblock), spins, S1_reduced, site_spins, coupled_basis,
+                                        su2_second_coefficient),
+    }
+
+    return EnlargedBlock(length=(block.length + 1),
+                        basis_size=len(new_spins),
+                        operator_dict=enlarged_operator_dict,
+                        basis_sector_array=coupled_basis[2])
+
+def su2_single_dmrg_step(sys, env, m, target_S, svd_method="full"):
+    """Performs a single DMRG step in the SU(2)-symmetric mode using `sys` as
+    the system and `env` as the environment, targeting the ground state of
+    total spin `target_S` and keeping a maximum of `m` multiplets in the new
+    basis.
+    """
+    assert is_valid_block(sys)
+    assert is_valid_block(env)
+    target_spin = int(round(2 * target_S))
+
+    # Enlarge each block by a single site.
+    sys_enl = su2_enlarge_block(sys)
+    if sys is env:  # no need to recalculate a second time
+        env_enl = sys_enl
+    else:
+        env_enl = su2_enlarge_block(env)
+
+    assert is_valid_enlarged_block(sys_enl)
+    assert is_valid_enlarged_block(env_enl)
+
+    # Build up the basis of superblock multiplets with the target total spin,
+    # which plays the role of the "restricted" basis of the S^z-conserving
+    # code.  For each spin of the enlarged system, the states run over the
+    # enlarged system multiplets of that spin (rows) and all enlarged
+    # environment multiplets that can couple with them to the target spin
+    # (columns), in row-major order.
+    sys_enl_spins = sys_enl.basis_sector_array
+    env_enl_spins = env_enl.basis_sector_array
+    sys_enl_basis_by_spin = index_map(sys_enl_spins)
+    sys_index = []
+    env_index = []
+    sector_indices = {}
+    for sys_enl_spin, sys_enl_basis_states in sys_enl_basis_by_spin.items():
+        env_states = [j for j, env_enl_spin in enumerate(env_enl_spins)
+                    if abs(sys_enl_spin - env_enl_spin) <= target_spin <= sys_enl_spin + env_enl_spin and
+                    (sys_enl_spin + env_enl_spin + target_spin) % 2 == 0]
+        start = len(sys_index)
+        for i in sys_enl_basis_states:
+            sys_index.extend([i] * len(env_states))
+            env_index.extend(env_states)
+        sector_indices[sys_enl_spin] = list(range(start, len(sys_index)))
+    coupled_basis = (np.array(sys_index, dtype=int), np.array(env_index, dtype=int),
+                    np.full(len(sys_index), target_spin, dtype=int))
+
+    # Construct the superblock Hamiltonian directly in this basis.
+    sys_enl_op = sys_enl.operator_dict
+    env_enl_op = env_enl.operator_dict
+    superblock_hamiltonian = (
+        su2_coupled_operator(sys_enl_op["H"], sys_enl_spins, identity(env_enl.basis_size), env_enl_spins,
+                            coupled_basis, su2_scalar_coefficient) +
+        su2_coupled_operator(identity(sys_enl.basis_size), sys_enl_spins, env_enl_op["H"], env_enl_spins,
+                            coupled_basis, su2_scalar_coefficient) +
+        J * su2_coupled_operator(sys_enl_op["conn_S"], sys_enl_spins, env_enl_op["conn_S"], env_enl_spins,
+                                coupled_basis, su2_dot_coefficient)
+    )
+
+    # Call ARPACK to find the superblock ground state.  ("SA" means find the
+    # "smallest in amplitude" eigenvalue.)
+    (energy,), psi0 = eigsh(superblock_hamiltonian, k=1, which="SA")
+
+    # Tracing out the environment (and averaging over the 2S+1 states of the
+    # superblock multiplet) leaves a reduced density matrix that is, for each
+    # spin j of the system, rho_j = X_j X_j^dagger spread evenly over the 2j+1
+    # states of each multiplet.  Each state of a multiplet therefore has
+    # eigenvalue w / (2j+1), where w is an eigenvalue of rho_j, so we rank the
+    # multiplets by the singular values of X_j / sqrt(2j+1).
+    sector_list = []
+    rho_factor_list = []
+    for sys_enl_spin, indices in sector_indices.items():
+        if indices: # if indices is nonempty
+            psi0_sector = psi0[indices, 0].reshape([len(sys_enl_basis_by_spin[sys_enl_spin]), -1], order="C")
+            sector_list.append(sys_enl_spin)
+            rho_factor_list.append(psi0_sector / np.sqrt(sys_enl_spin + 1))
+    multiplicity_list = [sys_enl_spin + 1 for sys_enl_spin in sector_list]
+    kept_states, kept_block_array, truncation_error = truncate_by_svd(rho_factor_list, m, svd_method,
+                                                                    multiplicity_list=multiplicity_list)
+    my_m = len(kept_block_array)
+    new_spin_array = np.array(sector_list, dtype=int)[kept_block_array]
+    rows, columns, values = [], [], []
+    for sys_enl_spin, (vectors, new_indices) in zip(sector_list, kept_states):
+        rows.append(np.repeat(sys_enl_basis_by_spin[sys_enl_spin], len(new_indices)))
+        columns.append(np.tile(new_indices, vectors.shape[0]))
+        values.append(vectors.reshape(-1))
+    transformation_matrix = csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(columns))),
+                                    shape=(sys_enl.basis_size, my_m))
+    print("number of kept multiplets:", my_m, "number of kept states:", np.sum(new_spin_array + 1))
+    print("truncation error:", truncation_error)
+
+    # Rotate and truncate each operator.  The transformation matrix never
+    # mixes multiplets of different spin, so the reduced matrix elements of
+    # "conn_S" transform exactly like ordinary matrix elements.
+    new_operator_dict = {}
+    for name, op in sys_enl.operator_dict.items():
+        new_operator_dict[name] = rotate_and_truncate(op, transformation_matrix)
+
+    newblock = Block(length=sys_enl.length,
+                    basis_size=my_m,
+                    operator_dict=new_operator_dict,
+                    basis_sector_array=new_spin_array)
+
+    return newblock, energy
+
+def su2_finite_system_algorithm(L, m_warmup, m_sweep_list, target_S, svd_method="full"):
+    """Runs the infinite and finite system algorithms in the SU(2)-symmetric
+    mode, targeting the ground state of total spin `target_S`, and returns
+    the energy of the last step.  Here `m_warmup` and `m_sweep_list` count
+    multiplets rather than states.
+    """
+    assert L % 2 == 0  # require that L is an even number
+    assert J == Jz and not np.any(H1)  # the model must be SU(2) symmetric
+
+    # To keep things simple, this dictionary is not actually saved to disk, but
+    # we use it to represent persistent storage.
+    block_disk = {}  # "disk" storage for Block objects
+
+    # Use the infinite system algorithm to build up to desired size.
+    block = su2_initial_block
+    block_disk["l", block.length] = block
+    block_disk["r", block.length] = block
+    while 2 * block.length < L:
+        print(graphic(block, block))
+        current_L = 2 * block.length + 2 # current superblock length
+        current_target_S = int(target_S) * current_L // L
+        block, energy = su2_single_dmrg_step(block, block, m=m_warmup, target_S=current_target_S)
+        print("E/L =", energy / current_L)
+        block_disk["l", block.length] = block
+        block_disk["r", block.length] = block
+
+    # Now that the system is built up to its full size, we perform sweeps using
+    # the finite system algorithm.
+    sys_label, env_label = "l", "r"
+    sys_block = block; del block  # rename the variable
+    for m in m_sweep_list:
+        while True:
+            # Load the appropriate environment block from "disk"
+            env_block = block_disk[env_label, L - sys_block.length - 2]
+            if env_block.length == 1:
+                # We've come to the end of the chain, so we reverse course.
+                sys_block, env_block = env_block, sys_block
+                sys_label, env_label = env_label, sys_label
+
+            # Perform a single DMRG step.
+            print(graphic(sys_block, env_block, sys_label))
+            sys_block, energy = su2_single_dmrg_step(sys_block, env_block, m=m, target_S=target_S,
+                                                    svd_method=svd_method)
+            print("E/L =", energy / L)
+
+            # Save the block from this step to disk.
+            block_disk[sys_label, sys_block.length] = sys_block
+
+            # Check whether we just completed a full sweep.
+            if sys_label == "l" and 2 * sys_block.length == L:
+                break  # escape from the "while True" loop
+    return energy
+#
+if __name__ == "__main__":
+    np.set_printoptions(precision=10, suppress=True, threshold=10000, linewidth=300)
+
+    #infinite_system_algorithm(L=100, m=20, target_Sz=0)
+    #finite_system_algorithm(L=20, m_warmup=10, m_sweep_list=[20,30,40,50], target_Sz=0)
+    # Model-specific code for the Heisenberg XXZ chain
+    #
+    model_d = 2  # single-site basis size
+    single_site_sectors = np.array([0.5, -0.5])  # S^z sectors corresponding to the
+                                                # single site basis elements
+
+    J = 1.  # coupling of the S^x S^x + S^y S^y terms
+    Jz = 1.  # coupling of the S^z S^z term
+
+    Sz1 = np.array([[0.5, 0], [0, -0.5]], dtype='d')  # single-site S^z
+    Sp1 = np.array([[0, 1], [0, 0]], dtype='d')  # single-site S^+
+
+    H1 = np.array([[0, 0], [0, 0]], dtype='d')  # single-site portion of H is zero
+    #
+    initial_block = single_site_block()
+    #
+    L = 20
+    m_warmup = 20
+    # We target the ground states of the S^z = 0 and S^z = 1 sectors at the
+    # same time, so that the spin gap comes out of a single calculation.
+    target_Sz_list = [0, 1]
+    m_sweep_list = [30, 30]
+    # weight of the density-matrix correction in each sweep; the last sweep is
+    # performed without correction.
+    alpha_sweep_list = [1e-3, 0.]
+    # Directory of the persistent cache of the blocks of the infinite system
+    # algorithm, shared between runs (e.g. at different L); None disables it.
+    warmup_cache_dir = None
+    # Compress the blocks saved to block_disk during the sweeps (see
+    # memory_report below for what that saves).
+    compress_cold_blocks = True
+    #
+    # We scan Jz.  Only the first point is computed from scratch; every later
+    # point continues from the blocks, transformation matrices and psi0 of its
+    # neighbour, which are an excellent starting basis, so the warmup is
+    # skipped and a single sweep is enough.
+    Jz_list = [1.0, 0.95, 0.9]
+    m_continuation_list = [30]
+    alpha_continuation_list = [0.]
+    energy_lists = []
+    for Jz in Jz_list:
+        print("==================== Jz =", Jz, "====================")
+        if not energy_lists:
+            block_disk, psi0_list = idmrg_produce_blocks(L=L, m_warmup=m_warmup, target_Sz_list=target_Sz_list,
+                                                        cache_dir=warmup_cache_dir)
+            #
+            print("--------idmrg enlarge block finished, begin fdmrg process--------")
+            # Now that the system is built up to its full size, we perform sweeps using
+            # the finite system algorithm. At first the left block will act as the system
+            # growing at the expense of the right block (the environment), but once
+            # we come to the end of the chian these roles will be reversed
+            trmat_disk = {} # "disk" storage for transformation matrix
+            energy_list, psi0_list = finite_system_sweeps(L, m_sweep_list, alpha_sweep_list, target_Sz_list,
+                                                        block_disk, trmat_disk, psi0_list,
+                                                        compress_cold_blocks=compress_cold_blocks)
+        else:
+            print("--------continue from the previous Jz, begin fdmrg process--------")
+            # Re-evaluate the Hamiltonian terms of the previous point's blocks
+            # in the basis it kept, and sweep starting from its psi0.
+            block_disk = rebuild_blocks(L, block_disk, trmat_disk)
+            trmat_disk = dict(trmat_disk)
+            energy_list, psi0_list = finite_system_sweeps(L, m_continuation_list, alpha_continuation_list, target_Sz_list,
+                                                        block_disk, trmat_disk, psi0_list,
+                                                        compress_cold_blocks=compress_cold_blocks)
+        energy_lists.append(energy_list)
     #
     # print the information of trmat_disk
     for it in list(trmat_disk.keys()):
-        print("index:", it, "shape of trmat", trmat_disk[it].shape)
\ No newline at end of file
+        print("index:", it, "shape of trmat", trmat_disk[it].shape)
+    # and the memory occupied by the blocks and transformation matrices
+    memory_report(block_disk, trmat_disk)
+    for Jz, (energy_Sz0, energy_Sz1) in zip(Jz_list, energy_lists):
+        print("Jz =", Jz, "E/L =", energy_Sz0 / L, "spin gap =", energy_Sz1 - energy_Sz0)
+    #
+    # The isotropic point Jz = J also conserves the total spin, which the
+    # SU(2)-symmetric mode exploits by keeping whole multiplets: a basis of m
+    # multiplets holds many more states, so a much smaller m reaches the same
+    # accuracy.  The spin-1/2 site is a single multiplet (2j = 1) with reduced
+    # matrix element <1/2||S||1/2> = sqrt(3/2).
+    Jz = J
+    single_site_spin = 1  # twice the spin of a single site
+    S1_reduced = np.array([[np.sqrt(1.5)]])
+    su2_initial_block = Block(length=1, basis_size=1, operator_dict={
+                            "H": np.array([[0.]]),
+                            "conn_S": S1_reduced,
+                            }, basis_sector_array=np.array([single_site_spin]))
+    su2_energy_S0 = su2_finite_system_algorithm(L=L, m_warmup=10, m_sweep_list=[15, 15], target_S=0)
+    su2_energy_S1 = su2_finite_system_algorithm(L=L, m_warmup=10, m_sweep_list=[15, 15], target_S=1)
+    print("SU(2) mode: Jz =", Jz, "E/L =", su2_energy_S0 / L, "spin gap =", su2_energy_S1 - su2_energy_S0)
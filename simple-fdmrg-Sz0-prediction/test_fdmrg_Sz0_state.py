@@ -0,0 +1,71 @@
+# Checks of fdmrg-Sz0-state.py, run with `python -m pytest`.
+#
+# The script reads the model (model_d, J, Jz, Sz1, ...) from module globals
+# that are set in its `__main__` section, so we load everything above that
+# section into this module and set the model here instead.
+import os
+
+import numpy as np
+
+script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fdmrg-Sz0-state.py")
+with open(script_path) as f:
+    exec(f.read().split('if __name__ == "__main__":')[0])
+
+def set_model(h=0.):
+    """Sets the model globals to the Heisenberg chain (J = Jz = 1) in a
+    magnetic field `h` along z, as the `__main__` section of the script does."""
+    global model_d, single_site_sectors, J, Jz, Sz1, Sp1, H1, initial_block
+    model_d = 2
+    single_site_sectors = np.array([0.5, -0.5])
+    J = 1.
+    Jz = 1.
+    Sz1 = np.array([[0.5, 0], [0, -0.5]], dtype='d')
+    Sp1 = np.array([[0, 1], [0, 0]], dtype='d')
+    H1 = -h * Sz1
+    initial_block = single_site_block()
+
+def run_from_scratch(L, m_warmup, m_sweep_list, target_Sz_list):
+    block_disk, psi0_list = idmrg_produce_blocks(L, m_warmup, target_Sz_list)
+    trmat_disk = {}
+    energy_list, psi0_list = finite_system_sweeps(L, m_sweep_list, [0.] * len(m_sweep_list), target_Sz_list,
+                                                block_disk, trmat_disk, psi0_list)
+    return energy_list, psi0_list, block_disk, trmat_disk
+
+def test_warm_start_after_field_change():
+    # The field commutes with H, so within a fixed S^z sector it only shifts
+    # the energy by -h S^z and the kept basis stays just as good.  A warm start
+    # must therefore reproduce the run from scratch to rounding.
+    L, target_Sz_list, h = 12, [1], 0.3
+    set_model(h=0.)
+    energy_list, psi0_list, block_disk, trmat_disk = run_from_scratch(L, 10, [20], target_Sz_list)
+
+    # A scan only changes the model parameters between points; in particular
+    # `initial_block` still holds the single-site H of the previous point.
+    global H1
+    H1 = -h * Sz1
+    block_disk = rebuild_blocks(L, block_disk, trmat_disk)
+    warm_energy_list, _ = finite_system_sweeps(L, [20], [0.], target_Sz_list, block_disk, dict(trmat_disk), psi0_list)
+
+    set_model(h=h)
+    scratch_energy_list = run_from_scratch(L, 10, [20], target_Sz_list)[0]
+
+    assert abs(warm_energy_list[0] - scratch_energy_list[0]) < 1e-8
+    assert abs(warm_energy_list[0] - (energy_list[0] - h * target_Sz_list[0])) < 1e-8
+
+def test_noise_with_dense_connection_operators():
+    # Whether an operator is stored dense or sparse depends on
+    # `sparse_fill_threshold`; storage is lossless, so the density-matrix
+    # correction must give the same result either way.
+    global sparse_fill_threshold
+    L, target_Sz_list = 12, [0]
+    set_model()
+    energy_list_by_threshold = []
+    default_threshold = sparse_fill_threshold
+    try:
+        for sparse_fill_threshold in (default_threshold, 0.2, 0.):
+            block_disk, psi0_list = idmrg_produce_blocks(L, 10, target_Sz_list)
+            energy_list, _ = finite_system_sweeps(L, [20, 20], [1e-3, 0.], target_Sz_list, block_disk, {}, psi0_list)
+            energy_list_by_threshold.append(energy_list[0])
+    finally:
+        sparse_fill_threshold = default_threshold
+    assert np.allclose(energy_list_by_threshold, energy_list_by_threshold[0], rtol=0, atol=1e-10)
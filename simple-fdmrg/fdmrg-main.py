@@ -1,19 +1,167 @@
 from __future__ import print_function, division  # requires Python >= 2.6
 # numpy and scipy imports
 import numpy as np
-from scipy.sparse import kron, identity
+from scipy.sparse import kron, identity, csr_matrix, issparse
 from scipy.sparse.linalg import eigsh  # Lanczos routine from ARPACK
-# We will use python's "namedtuple" to represent the Block and EnlargedBlock
-# objects
+from scipy.sparse.linalg import svds  # partial SVD, also from ARPACK
+# Used by the persistent cache of the blocks of the infinite system algorithm
+import hashlib
+import os
+import pickle
+import tempfile
+import zlib  # lossless compression of the operators of cold blocks
 from collections import namedtuple
 #
-Block = namedtuple("Block", ["length", "basis_size", "operator_dict"])
-EnlargedBlock = namedtuple("EnlargedBlock", ["length", "basis_size", "operator_dict"])
+# Operators with a smaller fraction of nonzero elements are stored as CSR
+# matrices.  (CSR takes less memory already below a fill of 2/3, but dense
+# products are faster until the matrix is quite sparse.)
+sparse_fill_threshold = 0.25
+# Bumped whenever the pickled form of a Block or of a cache entry changes, so
+# that the persistent cache of the infinite system algorithm never loads
+# entries of an old format.
+block_format_version = 2
+#
+def compact_operator(op):
+    """Returns `op` as a C-contiguous dense array or as a CSR matrix with
+    sorted indices, whichever suits its fill.
+    """
+    if issparse(op):
+        op = op.tocsr()
+        nnz = op.count_nonzero()
+    else:
+        op = np.asarray(op)
+        nnz = np.count_nonzero(op)
+    if nnz <= sparse_fill_threshold * op.shape[0] * op.shape[1]:
+        op = csr_matrix(op)
+        op.eliminate_zeros()
+        op.sort_indices()
+        return op
+    if issparse(op):
+        op = op.toarray()
+    return np.ascontiguousarray(op)
+
+def operator_nbytes(op):
+    """Returns the number of bytes occupied by the data of an operator as
+    stored by `Block`, including the index arrays of CSR matrices and the
+    compressed form of compressed operators.
+    """
+    if isinstance(op, CompressedOperator):
+        return sum(len(buffer) for buffer in op.buffers)
+    if issparse(op):
+        return op.data.nbytes + op.indices.nbytes + op.indptr.nbytes
+    return op.nbytes
+
+# Each array of an operator (the dense array, or the data, indices and indptr
+# of a CSR matrix) is compressed separately; `dtypes` are needed to read them
+# back.
+CompressedOperator = namedtuple("CompressedOperator", ["format", "shape", "dtypes", "buffers"])
+
+def compress_operator(op):
+    if issparse(op):
+        arrays = [op.data, op.indices, op.indptr]
+    else:
+        arrays = [op]
+    return CompressedOperator(format="csr" if issparse(op) else "dense",
+                            shape=op.shape,
+                            dtypes=[array.dtype.str for array in arrays],
+                            buffers=[zlib.compress(np.ascontiguousarray(array).tobytes()) for array in arrays])
+
+def decompress_operator(compressed):
+    # `np.frombuffer` gives read-only views of the decompressed bytes, so we
+    # copy them to hand out ordinary (writable) arrays.
+    arrays = [np.frombuffer(zlib.decompress(buffer), dtype=dtype).copy()
+            for dtype, buffer in zip(compressed.dtypes, compressed.buffers)]
+    if compressed.format == "csr":
+        return csr_matrix(tuple(arrays), shape=compressed.shape)
+    return arrays[0].reshape(compressed.shape)
+
+# We represent the Block and EnlargedBlock objects with a small class that
+# stores every operator compactly: a C-contiguous dense array if it is mostly
+# nonzero, a CSR matrix otherwise.  A block that is not needed for a while,
+# such as the environment blocks kept on "disk" during the sweeps, can
+# additionally be compressed losslessly with zlib; its operators are then
+# decompressed on access.
+class Block(object):
+    """A block of the chain: its length, the size of its basis and the
+    operators we keep track of (`operator_dict`).  The operators are stored by
+    `compact_operator`.
+    """
+    __slots__ = ("length", "basis_size", "_operators", "compressed")
+
+    def __init__(self, length, basis_size, operator_dict, compressed=False):
+        self.length = length
+        self.basis_size = basis_size
+        self._operators = dict((name, compact_operator(op)) for name, op in operator_dict.items())
+        self.compressed = False
+        if compressed:
+            self._operators = dict((name, compress_operator(op)) for name, op in self._operators.items())
+            self.compressed = True
+
+    @property
+    def operator_dict(self):
+        """A new dictionary of the operators.  Those of a compressed block are
+        decompressed anew on each access, so fetch it once per step."""
+        if self.compressed:
+            return dict((name, decompress_operator(op)) for name, op in self._operators.items())
+        return dict(self._operators)
+
+    def compress(self):
+        """Returns a copy of the block with its operators compressed."""
+        if self.compressed:
+            return self
+        return type(self)(self.length, self.basis_size, self._operators, compressed=True)
+
+    def is_valid(self):
+        """Checks that every operator matches the basis size.  (We look at the
+        operators as stored, since going through `operator_dict` would
+        decompress a compressed block only to check the shapes.)"""
+        for op in self._operators.values():
+            if op.shape[0] != self.basis_size or op.shape[1] != self.basis_size:
+                return False
+        return True
+
+    def nbytes(self):
+        """Returns the number of bytes occupied by the operators of the
+        block."""
+        return sum(operator_nbytes(op) for op in self._operators.values())
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return "%s(length=%d, basis_size=%d, operators=%s%s)" % (
+            type(self).__name__, self.length, self.basis_size, sorted(self._operators),
+            ", compressed" if self.compressed else "")
+
+class EnlargedBlock(Block):
+    __slots__ = ()
+
+def memory_report(block_disk):
+    """Prints the memory occupied by each block in `block_disk` along with the
+    total, and returns the total number of bytes.  A block stored under
+    several keys (as the blocks of the infinite system algorithm are) is only
+    counted once.
+    """
+    total = 0
+    counted = set()
+    print("label length basis_size   operators(bytes)  compressed")
+    for (label, length), block in sorted(block_disk.items()):
+        nbytes = block.nbytes()
+        shared = id(block) in counted
+        print("%5s %6d %10d %18d  %s%s" % (label, length, block.basis_size, nbytes, block.compressed,
+                                        " (shared)" if shared else ""))
+        if not shared:
+            counted.add(id(block))
+            total += nbytes
+    print("total: %.3f MB" % (total / 2.**20))
+    return total
+#
 def is_valid_block(block):
-    for op in block.operator_dict.values():
-        if op.shape[0] != block.basis_size or op.shape[1] != block.basis_size:
-            return False
-    return True
+    return block.is_valid()
 # This function should test the same exact things, so there is no need to
 # repeat its definition.
 is_valid_enlarged_block = is_valid_block
@@ -23,7 +171,6 @@ def H2(Sz1, Sp1, Sz2, Sp2):  # two-site part of H
     (e.g. two blocks), returns a Kronecker product representing the
     corresponding two-site term in the Hamiltonian that joins the two sites.
     """
-    J = Jz = 1.
     return (
         (J / 2) * (kron(Sp1, Sp2.conjugate().transpose()) + kron(Sp1.conjugate().transpose(), Sp2)) +
         Jz * kron(Sz1, Sz2)
@@ -57,9 +204,31 @@ def rotate_and_truncate(operator, transformation_matrix):
     """
     return transformation_matrix.conjugate().transpose().dot(operator.dot(transformation_matrix))
 
-def single_dmrg_step(sys, env, m):
+def randomized_svd(matrix, k, n_oversamples=10, n_power_iterations=2):
+    """Returns approximations to the `k` largest singular values of `matrix`
+    and the corresponding left singular vectors, found by projecting onto a
+    random subspace that is refined by a few power iterations.  A fixed seed
+    keeps the DMRG steps reproducible.
+    """
+    random_state = np.random.RandomState(0)
+    sketch = matrix.dot(random_state.standard_normal((matrix.shape[1], k + n_oversamples)))
+    for i in range(n_power_iterations):
+        # Re-orthonormalize between the multiplications to keep the small
+        # singular values from being lost to rounding.
+        sketch, _ = np.linalg.qr(sketch)
+        sketch, _ = np.linalg.qr(matrix.conjugate().transpose().dot(sketch))
+        sketch = matrix.dot(sketch)
+    q, _ = np.linalg.qr(sketch)
+    u, s, vh = np.linalg.svd(q.conjugate().transpose().dot(matrix), full_matrices=False)
+    return q.dot(u[:, :k]), s[:k]
+
+def single_dmrg_step(sys, env, m, alpha=0., svd_method="full"):
     """Performs a single DMRG step using `sys` as the system and `env` as the
-    environment, keeping a maximum of `m` states in the new basis.
+    environment, keeping a maximum of `m` states in the new basis.  If `alpha`
+    is nonzero, White's density-matrix correction with weight `alpha` is added
+    to the reduced density matrix.  `svd_method` is "full" for a complete SVD
+    of the wavefunction, or "partial" (ARPACK) or "randomized" to compute only
+    the leading `m` singular triplets when `m` is much smaller than the basis.
     """
     assert is_valid_block(sys)
     assert is_valid_block(env)
@@ -86,32 +255,54 @@ def single_dmrg_step(sys, env, m):
     # "smallest in amplitude" eigenvalue.)
     (energy,), psi0 = eigsh(superblock_hamiltonian, k=1, which="SA")
 
-    # Construct the reduced density matrix of the system by tracing out the
-    # environment
+    # The reduced density matrix of the system, obtained by tracing out the
+    # environment, is rho = X X^dagger with X = psi0.  We never form rho;
+    # instead we find its eigenvectors as the left singular vectors of X, with
+    # the squared singular values as eigenvalues.
     #
     # We want to make the (sys, env) indices correspond to (row, column) of a
     # matrix, respectively.  Since the environment (column) index updates most
     # quickly in our Kronecker product structure, psi0 is thus row-major ("C
     # style").
     psi0 = psi0.reshape([sys_enl.basis_size, -1], order="C")
-    rho = np.dot(psi0, psi0.conjugate().transpose())
-
-    # Diagonalize the reduced density matrix and sort the eigenvectors by
-    # eigenvalue.
-    evals, evecs = np.linalg.eigh(rho)
-    possible_eigenstates = []
-    for eval, evec in zip(evals, evecs.transpose()):
-        possible_eigenstates.append((eval, evec))
-    possible_eigenstates.sort(reverse=True, key=lambda x: x[0])  # largest eigenvalue first
+    rho_factor = [psi0]
+
+    # Add White's density-matrix correction (perturbation), which mixes in the
+    # states reached by acting on psi0 with the connection operators of the
+    # enlarged system.  This lets the sweep recover states (e.g. quantum number
+    # sectors) that are missing from psi0 itself, so fewer sweeps are needed.
+    # Appending sqrt(alpha) O psi0 to the columns of X adds
+    # alpha O psi0 psi0^dagger O^dagger to rho, and the result is normalized so
+    # that the trace of rho is one again.
+    if alpha != 0:
+        for op in (sys_enl_op["conn_Sz"], sys_enl_op["conn_Sp"], sys_enl_op["conn_Sp"].conjugate().transpose()):
+            rho_factor.append(np.sqrt(alpha) * op.dot(psi0))
+    rho_factor = np.hstack(rho_factor)
+    rho_factor /= np.linalg.norm(rho_factor)
 
     # Build the transformation matrix from the `m` overall most significant
-    # eigenvectors.
-    my_m = min(len(possible_eigenstates), m)
-    transformation_matrix = np.zeros((sys_enl.basis_size, my_m), dtype='d', order='F')
-    for i, (eval, evec) in enumerate(possible_eigenstates[:my_m]):
-        transformation_matrix[:, i] = evec
-
-    truncation_error = 1 - sum([x[0] for x in possible_eigenstates[:my_m]])
+    # eigenvectors.  The SVD returns them sorted with the largest singular
+    # value first.  The discarded weight is summed directly rather than
+    # obtained as one minus the kept weight.
+    assert svd_method in ("full", "partial", "randomized")
+    my_m = min(m, min(rho_factor.shape))
+    if svd_method != "full" and 2 * my_m < min(rho_factor.shape):
+        if svd_method == "partial":
+            vectors, singular_values, _ = svds(rho_factor, k=my_m)
+            order = np.argsort(-singular_values)
+            vectors, singular_values = vectors[:, order], singular_values[order]
+        else:
+            vectors, singular_values = randomized_svd(rho_factor, my_m)
+        # The weight outside the span of the computed singular vectors is
+        # discarded.  We sum it directly as the squared norm of the part of X
+        # that they miss, rather than as one minus the kept weight, which loses
+        # all precision once the truncation error is small.
+        residual = rho_factor - vectors.dot(vectors.conjugate().transpose().dot(rho_factor))
+        truncation_error = np.linalg.norm(residual) ** 2
+    else:
+        vectors, singular_values, _ = np.linalg.svd(rho_factor, full_matrices=False)
+        truncation_error = np.sum(singular_values[my_m:] ** 2)
+    transformation_matrix = np.asfortranarray(vectors[:, :my_m])
     print("truncation error:", truncation_error)
 
     # Rotate and truncate each operator.
@@ -147,27 +338,86 @@ def infinite_system_algorithm(L, m):
         block, energy = single_dmrg_step(block, block, m=m)
         print("E/L =", energy / (block.length * 2))
 
-def finite_system_algorithm(L, m_warmup, m_sweep_list):
+def warmup_cache_key(m_warmup):
+    """Returns the content key of the initial block of the infinite system
+    algorithm: a hash of the model parameters and of `m_warmup`.  The block
+    produced by each later step is keyed by the key of the previous block (see
+    `idmrg_produce_blocks`).
+    """
+    key = hashlib.sha1()
+    key.update(repr((block_format_version, model_d, J, Jz, m_warmup)).encode())
+    for array in (Sz1, Sp1, H1):
+        key.update(np.ascontiguousarray(array, dtype='d').tobytes())
+    return key.hexdigest()
+
+def idmrg_produce_blocks(L, m_warmup, cache_dir=None):
+    """Uses the infinite system algorithm to build up the blocks of every
+    length up to L/2.  Each time we construct a block, we save it for future
+    reference as both a left ("l") and right ("r") block, as the infinite
+    system algorithm assumes the environment is a mirror image of the system.
+
+    If `cache_dir` is given, each block is stored there under a content key
+    that depends on the model parameters, `m_warmup` and its length, and
+    blocks already in the cache are loaded instead of recomputed.  The blocks
+    do not depend on L, so e.g. a run at L=200 reuses the growth of an earlier
+    run at L=100 and only extends it.
+    """
     assert L % 2 == 0  # require that L is an even number
 
     # To keep things simple, this dictionary is not actually saved to disk, but
     # we use it to represent persistent storage.
     block_disk = {}  # "disk" storage for Block objects
 
-    # Use the infinite system algorithm to build up to desired size.  Each time
-    # we construct a block, we save it for future reference as both a left
-    # ("l") and right ("r") block, as the infinite system algorithm assumes the
-    # environment is a mirror image of the system.
     block = initial_block
     block_disk["l", block.length] = block
     block_disk["r", block.length] = block
+    if cache_dir is not None:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        key = warmup_cache_key(m_warmup)
     while 2 * block.length < L:
-        # Perform a single DMRG step and save the new Block to "disk"
-        print(graphic(block, block))
-        block, energy = single_dmrg_step(block, block, m=m_warmup)
+        if cache_dir is not None:
+            key = hashlib.sha1(key.encode()).hexdigest()
+            cache_path = os.path.join(cache_dir, key + ".pickle")
+        if cache_dir is not None and os.path.exists(cache_path):
+            # Load the new Block from the cache
+            with open(cache_path, "rb") as f:
+                block, energy = pickle.load(f)
+            print(graphic(block, block), "(from cache)")
+        else:
+            # Perform a single DMRG step and save the new Block to "disk"
+            print(graphic(block, block))
+            block, energy = single_dmrg_step(block, block, m=m_warmup)
+            if cache_dir is not None:
+                # Write to a temporary file of our own first, so that neither an
+                # interrupted run nor another run writing the same entry at the
+                # same time ever leaves a truncated entry in the cache.
+                fd, temporary_path = tempfile.mkstemp(suffix=".tmp", dir=cache_dir)
+                try:
+                    with os.fdopen(fd, "wb") as f:
+                        pickle.dump((block, energy), f, pickle.HIGHEST_PROTOCOL)
+                    os.rename(temporary_path, cache_path)
+                finally:
+                    # Only still there if writing or renaming failed
+                    if os.path.exists(temporary_path):
+                        os.remove(temporary_path)
         print("E/L =", energy / (block.length * 2))
         block_disk["l", block.length] = block
         block_disk["r", block.length] = block
+    return block_disk
+
+def finite_system_algorithm(L, m_warmup, m_sweep_list, alpha_sweep_list=None, svd_method="full",
+                            warmup_cache_dir=None, compress_cold_blocks=False):
+    assert L % 2 == 0  # require that L is an even number
+    # The noise schedule gives the weight of the density-matrix correction for
+    # each sweep; by default no correction is applied.
+    if alpha_sweep_list is None:
+        alpha_sweep_list = [0.] * len(m_sweep_list)
+    assert len(alpha_sweep_list) == len(m_sweep_list)
+
+    # Use the infinite system algorithm to build up to desired size.
+    block_disk = idmrg_produce_blocks(L, m_warmup, cache_dir=warmup_cache_dir)
+    block = block_disk["l", L // 2]
 
     # Now that the system is built up to its full size, we perform sweeps using
     # the finite system algorithm.  At first the left block will act as the
@@ -175,7 +425,7 @@ def finite_system_algorithm(L, m_warmup, m_sweep_list):
     # once we come to the end of the chain these roles will be reversed.
     sys_label, env_label = "l", "r"
     sys_block = block; del block  # rename the variable
-    for m in m_sweep_list:
+    for m, alpha in zip(m_sweep_list, alpha_sweep_list):
         while True:
             # Load the appropriate environment block from "disk"
             env_block = block_disk[env_label, L - sys_block.length - 2]
@@ -186,12 +436,17 @@ def finite_system_algorithm(L, m_warmup, m_sweep_list):
 
             # Perform a single DMRG step.
             print(graphic(sys_block, env_block, sys_label))
-            sys_block, energy = single_dmrg_step(sys_block, env_block, m=m)
+            sys_block, energy = single_dmrg_step(sys_block, env_block, m=m, alpha=alpha, svd_method=svd_method)
 
             print("E/L =", energy / L)
 
-            # Save the block from this step to disk.
-            block_disk[sys_label, sys_block.length] = sys_block
+            # Save the block from this step to disk.  It is only needed again as
+            # the environment half a sweep later, so it may be compressed.
+            # (We keep working with the uncompressed block as the system.)
+            if compress_cold_blocks:
+                block_disk[sys_label, sys_block.length] = sys_block.compress()
+            else:
+                block_disk[sys_label, sys_block.length] = sys_block
 
             # Check whether we just completed a full sweep.
             if sys_label == "l" and 2 * sys_block.length == L:
@@ -204,6 +459,8 @@ if __name__ == "__main__":
     # 定义模型哈密顿量
     # Model-specific code for the Heisenberg XXZ chain
     model_d = 2  # single-site basis size
+    J = 1.  # coupling of the S^x S^x + S^y S^y terms
+    Jz = 1.  # coupling of the S^z S^z term
     Sz1 = np.array([[0.5, 0], [0, -0.5]], dtype='d')  # single-site S^z
     Sp1 = np.array([[0, 1], [0, 0]], dtype='d')  # single-site S^+
     H1 = np.array([[0, 0], [0, 0]], dtype='d')  # single-site portion of H is zero
@@ -222,31 +479,29 @@ if __name__ == "__main__":
     L = 100  # 尺寸
     m_warmup = 10 # iDMRG algotithm 中用到的保留态个数
     # (1) 进行 iDMRG 热身
-    block_disk = {} # "disk" storage for Block objects
-    block = initial_block
-    block_disk["l", block.length] = block
-    block_disk["r", block.length] = block 
-    while 2 * block.length < L:
-        # Perform a single DMRG step and save the new Block to "disk"
-        print(graphic(block, block))
-        block, energy = single_dmrg_step(block, block, m = m_warmup)
-        block_disk["l", block.length] = block
-        block_disk["r", block.length] = block
-        #print("block_disk:\n", block_disk)
-        print("block_basis_size:", block.basis_size)
-        print("block_length:", block.length) 
+    # 热身得到的 block 缓存目录，不同 L 的计算可以共用；None 表示不缓存
+    # directory of the persistent cache of warmup blocks; None disables it
+    warmup_cache_dir = None
+    block_disk = idmrg_produce_blocks(L, m_warmup, cache_dir=warmup_cache_dir) # "disk" storage for Block objects
+    block = block_disk["l", L // 2]
     #print("block_disk:\n", block_disk)
     #-------------------------------------------------------------#
     # 进行有限尺寸DMRG sweep
     L = 100 # 系统尺寸
     # m_sweep_list= [10, 20, 30, 40, 50] # sweep 过程中保留态个数
     m_sweep_list = [20, 30]
+    # 每次 sweep 中密度矩阵微扰(noise)的权重，最后一次 sweep 取零
+    # weight of the density-matrix correction in each sweep
+    alpha_sweep_list = [1e-3, 0.]
+    # 压缩 sweep 过程中存入 block_disk 的 block
+    # compress the blocks saved to block_disk during the sweeps
+    compress_cold_blocks = True
     sys_label, env_label = "l", "r"
     # 将 iDMRG 最后一步更新得到的 block 作为 fDMRG 的初始系统块儿 
     sys_block = block # rename the variable, 
     del block #
     print("-------------begin finite DMRG Sweep-----------------")
-    for m in m_sweep_list:
+    for m, alpha in zip(m_sweep_list, alpha_sweep_list):
         while True:
             # Load the appropriate enviroment block from "disk"
             env_block = block_disk[env_label, L - sys_block.length - 2]
@@ -262,11 +517,14 @@ if __name__ == "__main__":
                 sys_label, env_label = env_label, sys_label
             # Perform a single DMRG step
             print(graphic(sys_block=sys_block, env_block=env_block, sys_label=sys_label))
-            sys_block, energy = single_dmrg_step(sys=sys_block, env=env_block, m=m)
+            sys_block, energy = single_dmrg_step(sys=sys_block, env=env_block, m=m, alpha=alpha)
             print("E/L=", energy / L)
 
             # Save the block from this step to disk.
-            block_disk[sys_label, sys_block.length] = sys_block
+            if compress_cold_blocks:
+                block_disk[sys_label, sys_block.length] = sys_block.compress()
+            else:
+                block_disk[sys_label, sys_block.length] = sys_block
 
             # check whether we just completed a full sweep.
             if sys_label == "l" and 2 * sys_block.length == L:
@@ -277,3 +535,6 @@ if __name__ == "__main__":
 
 
 
+    # 打印 block_disk 占用的内存
+    # print the memory occupied by the blocks
+    memory_report(block_disk)